@@ -1,24 +1,68 @@
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, ForeignKey, Enum as SQLEnum
+from sqlalchemy import (
+    create_engine, event, Column, String, Integer, DateTime, ForeignKey, Index, LargeBinary, Enum as SQLEnum
+)
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
-from uuid import uuid4
+from uuid import UUID, uuid4
 
 # Database configuration
 SQLALCHEMY_DATABASE_URL = "sqlite:///./stock_exchange.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    query_cache_size=1200  # compiled statement cache, default 500
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the writer and needs a single fsync per commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-64000")  # 64 MB page cache
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.close()
+
+# Objects stay loaded after commit, so handlers can build responses without a re-SELECT
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
 # Import enums (will be defined in schemas.py)
 from schemas import Direction, OrderStatus, UserRole
 
 
+class BinaryUUID(TypeDecorator):
+    """UUID stored as raw 16 bytes instead of 36-char text; loaded back as uuid.UUID"""
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, UUID):
+            value = UUID(str(value))
+        return value.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return UUID(bytes=value)
+
+
 # SQLAlchemy Models
 class UserDB(Base):
     __tablename__ = "users"
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    id = Column(BinaryUUID, primary_key=True, default=uuid4)
     name = Column(String, nullable=False)
     role = Column(SQLEnum(UserRole), default=UserRole.USER)
     api_key = Column(String, nullable=False, unique=True)
@@ -41,33 +85,47 @@ class InstrumentDB(Base):
 class MarketOrderDB(Base):
     __tablename__ = "market_orders"
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    status = Column(SQLEnum(OrderStatus), default=OrderStatus.NEW)
-    user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    instrument_id = Column(Integer, ForeignKey("instruments.id"), nullable=False)
+    id = Column(BinaryUUID, primary_key=True, default=uuid4)
+    status = Column(SQLEnum(OrderStatus), default=OrderStatus.NEW, index=True)
+    user_id = Column(BinaryUUID, ForeignKey("users.id"), nullable=False, index=True)
+    instrument_id = Column(Integer, ForeignKey("instruments.id"), nullable=False, index=True)
     direction = Column(SQLEnum(Direction), nullable=False)
     qty = Column(Integer, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, server_default=func.now())
 
     user = relationship("UserDB", back_populates="market_orders")
     instrument = relationship("InstrumentDB", back_populates="market_orders")
 
+    @property
+    def ticker(self):
+        # Lets the response schemas validate directly from the ORM object
+        return self.instrument.ticker
+
 
 class LimitOrderDB(Base):
     __tablename__ = "limit_orders"
-
-    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    status = Column(SQLEnum(OrderStatus), default=OrderStatus.NEW)
-    user_id = Column(String, ForeignKey("users.id"), nullable=False)
-    instrument_id = Column(Integer, ForeignKey("instruments.id"), nullable=False)
+    __table_args__ = (
+        # Order book lookup: best price per instrument and side
+        Index("ix_limit_book", "instrument_id", "direction", "price"),
+    )
+
+    id = Column(BinaryUUID, primary_key=True, default=uuid4)
+    status = Column(SQLEnum(OrderStatus), default=OrderStatus.NEW, index=True)
+    user_id = Column(BinaryUUID, ForeignKey("users.id"), nullable=False, index=True)
+    instrument_id = Column(Integer, ForeignKey("instruments.id"), nullable=False, index=True)
     direction = Column(SQLEnum(Direction), nullable=False)
     qty = Column(Integer, nullable=False)
-    price = Column(Integer, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    price = Column(Integer, nullable=False, index=True)
+    timestamp = Column(DateTime, server_default=func.now())
 
     user = relationship("UserDB", back_populates="limit_orders")
     instrument = relationship("InstrumentDB", back_populates="limit_orders")
 
+    @property
+    def ticker(self):
+        # Lets the response schemas validate directly from the ORM object
+        return self.instrument.ticker
+
 
 def get_db():
     db = SessionLocal()
@@ -1,14 +1,69 @@
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional
+from uuid import UUID
+from cachetools import TTLCache
 from fastapi import HTTPException, Depends
 from sqlalchemy.orm import Session
 from database import get_db, UserDB, InstrumentDB
+from schemas import UserRole
 
-def get_user_by_api_key(db: Session, api_key: str):
-    return db.query(UserDB).filter(UserDB.api_key == api_key).first()
 
-def get_instrument_by_ticker(db: Session, ticker: str):
-    return db.query(InstrumentDB).filter(InstrumentDB.ticker == ticker).first()
+# Lightweight snapshots kept in the cache instead of ORM objects,
+# which would be detached once the request session is closed
+@dataclass(frozen=True)
+class CachedUser:
+    id: UUID
+    name: str
+    role: UserRole
+    api_key: str
 
-def authenticate_user(api_key: str, db: Session = Depends(get_db)):
+
+@dataclass(frozen=True)
+class CachedInstrument:
+    id: int
+    name: str
+    ticker: str
+
+
+_user_cache = TTLCache(maxsize=10_000, ttl=60)
+_instrument_cache = TTLCache(maxsize=10_000, ttl=60)
+_cache_lock = Lock()  # TTLCache is not thread-safe
+
+
+def get_user_by_api_key(db: Session, api_key: str) -> Optional[CachedUser]:
+    with _cache_lock:
+        user = _user_cache.get(api_key)
+    if user is None:
+        db_user = db.query(UserDB).filter(UserDB.api_key == api_key).first()
+        if not db_user:
+            return None
+        user = CachedUser(id=db_user.id, name=db_user.name, role=db_user.role, api_key=db_user.api_key)
+        with _cache_lock:
+            _user_cache[api_key] = user
+    return user
+
+def get_instrument_by_ticker(db: Session, ticker: str) -> Optional[CachedInstrument]:
+    with _cache_lock:
+        instrument = _instrument_cache.get(ticker)
+    if instrument is None:
+        db_instrument = db.query(InstrumentDB).filter(InstrumentDB.ticker == ticker).first()
+        if not db_instrument:
+            return None
+        instrument = CachedInstrument(id=db_instrument.id, name=db_instrument.name, ticker=db_instrument.ticker)
+        with _cache_lock:
+            _instrument_cache[ticker] = instrument
+    return instrument
+
+def invalidate_user(api_key: str):
+    with _cache_lock:
+        _user_cache.pop(api_key, None)
+
+def invalidate_instrument(ticker: str):
+    with _cache_lock:
+        _instrument_cache.pop(ticker, None)
+
+def authenticate_user(api_key: str, db: Session = Depends(get_db)) -> CachedUser:
     user = get_user_by_api_key(db, api_key)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid API key")
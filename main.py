@@ -1,8 +1,9 @@
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-from uuid import UUID
+from fastapi import FastAPI, Depends, HTTPException, BackgroundTasks, Query, Body
+from sqlalchemy import insert
+from sqlalchemy.orm import Session, joinedload
+from typing import Annotated, List
+from uuid import UUID, uuid4
 from datetime import datetime
 
 # Import all modules
@@ -10,10 +11,13 @@ from database import Base, engine, get_db, UserDB, InstrumentDB, MarketOrderDB,
 from schemas import (
     User, UserCreate, Instrument, InstrumentCreate,
     MarketOrder, MarketOrderCreate, LimitOrder, LimitOrderCreate,
-    OrderMessage
+    OrderMessage, OrderStatus
 )
-from dependencies import authenticate_user, get_user_by_api_key, get_instrument_by_ticker
-from messaging import rabbitmq, order_publisher
+from dependencies import (
+    CachedUser, authenticate_user, get_user_by_api_key, get_instrument_by_ticker,
+    invalidate_user, invalidate_instrument
+)
+from messaging import async_rabbitmq, order_publisher
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
@@ -23,14 +27,16 @@ app = FastAPI(title="Stock Exchange API", version="1.0.0")
 
 @app.on_event("startup")
 async def startup_event():
-    # Initialize RabbitMQ connection
-    rabbitmq.connect()
+    # Initialize RabbitMQ connection on the app's event loop and declare the topology once
+    if await async_rabbitmq.connect():
+        await order_publisher.setup_exchange()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    # Clean up RabbitMQ connection
-    rabbitmq.disconnect()
+    # Clean up publisher channels and the RabbitMQ connection
+    await order_publisher.close()
+    await async_rabbitmq.disconnect()
 
 
 # Basic routes
@@ -45,22 +51,19 @@ async def health_check():
 
 ###
 
-@app.post("/api/v1/public/register", response_model=User)
 def create_user(user: UserCreate, db: Session = Depends(get_db)):
+    # Check if API key already exists
     existing_user = get_user_by_api_key(db, user.api_key)
     if existing_user:
         raise HTTPException(status_code=400, detail="API key already exists")
 
-    db_user = UserDB(**user.dict())
+    db_user = UserDB(id=uuid4(), **user.model_dump())
     db.add(db_user)
     db.commit()
-    db.refresh(db_user)
-    return User(
-        id=UUID(db_user.id),
-        name=db_user.name,
-        role=db_user.role,
-        api_key=db_user.api_key
-    )
+    invalidate_user(db_user.api_key)
+    return User.model_validate(db_user)
+
+app.add_api_route("/api/v1/public/register", create_user, methods=["POST"], response_model=User)
 
 @app.get("/api/v1/public/instrument")
 async def get_instruments():
@@ -73,36 +76,15 @@ async def get_instruments():
 
 
 # User routes
-@app.post("/users", response_model=User)
-def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    # Check if API key already exists
-    existing_user = get_user_by_api_key(db, user.api_key)
-    if existing_user:
-        raise HTTPException(status_code=400, detail="API key already exists")
-
-    db_user = UserDB(**user.dict())
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return User(
-        id=UUID(db_user.id),
-        name=db_user.name,
-        role=db_user.role,
-        api_key=db_user.api_key
-    )
+app.add_api_route("/users", create_user, methods=["POST"], response_model=User)
 
 
 @app.get("/users/{user_id}", response_model=User)
-def get_user(user_id: str, db: Session = Depends(get_db)):
-    db_user = db.query(UserDB).filter(UserDB.id == user_id).first()
+def get_user(user_id: UUID, db: Session = Depends(get_db)):
+    db_user = db.get(UserDB, user_id)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(
-        id=UUID(db_user.id),
-        name=db_user.name,
-        role=db_user.role,
-        api_key=db_user.api_key
-    )
+    return User.model_validate(db_user)
 
 
 # Instrument routes
@@ -113,24 +95,21 @@ def create_instrument(instrument: InstrumentCreate, db: Session = Depends(get_db
     if existing_instrument:
         raise HTTPException(status_code=400, detail="Ticker already exists")
 
-    db_instrument = InstrumentDB(**instrument.dict())
+    db_instrument = InstrumentDB(**instrument.model_dump())
     db.add(db_instrument)
-    db.commit()
-    db.refresh(db_instrument)
-    return Instrument(
-        id=db_instrument.id,
-        name=db_instrument.name,
-        ticker=db_instrument.ticker
-    )
+    db.commit()  # autoincrement id is populated by the flush
+    invalidate_instrument(db_instrument.ticker)
+    return Instrument.model_validate(db_instrument)
 
 
 @app.get("/instruments", response_model=List[Instrument])
-def list_instruments(db: Session = Depends(get_db)):
-    instruments = db.query(InstrumentDB).all()
-    return [
-        Instrument(id=inst.id, name=inst.name, ticker=inst.ticker)
-        for inst in instruments
-    ]
+def list_instruments(
+        limit: int = Query(100, ge=1, le=1000),
+        offset: int = Query(0, ge=0),
+        db: Session = Depends(get_db)
+):
+    instruments = db.query(InstrumentDB).order_by(InstrumentDB.id).limit(limit).offset(offset).all()
+    return [Instrument.model_validate(inst) for inst in instruments]
 
 
 @app.get("/instruments/{ticker}", response_model=Instrument)
@@ -138,180 +117,182 @@ def get_instrument(ticker: str, db: Session = Depends(get_db)):
     db_instrument = get_instrument_by_ticker(db, ticker)
     if not db_instrument:
         raise HTTPException(status_code=404, detail="Instrument not found")
-    return Instrument(
-        id=db_instrument.id,
-        name=db_instrument.name,
-        ticker=db_instrument.ticker
-    )
+    return Instrument.model_validate(db_instrument)
 
 
 # Order routes
-@app.post("/orders/market", response_model=MarketOrder)
-async def create_market_order(
-        order: MarketOrderCreate,
-        api_key: str,
-        user: UserDB = Depends(authenticate_user),
-        db: Session = Depends(get_db)
-):
+def _create_order(order_type: str, order, user: CachedUser, db: Session, background_tasks: BackgroundTasks):
+    """Shared market/limit path: check the instrument, insert the order, publish it after the response"""
     # Verify instrument exists
     instrument = get_instrument_by_ticker(db, order.ticker)
     if not instrument:
         raise HTTPException(status_code=404, detail="Instrument not found")
 
-    # Create order in database
-    db_order = MarketOrderDB(
+    order_model, response_model = (MarketOrderDB, MarketOrder) if order_type == "market" else (LimitOrderDB, LimitOrder)
+    fields = order.model_dump(exclude={"ticker"})  # direction, qty and, for limit orders, price
+
+    # Create order in database; all fields are set here so the row needn't be reloaded after commit
+    db_order = order_model(
+        id=uuid4(),
+        status=OrderStatus.NEW,
         user_id=user.id,
         instrument_id=instrument.id,
-        direction=order.direction,
-        qty=order.qty
+        timestamp=datetime.utcnow(),
+        **fields
     )
     db.add(db_order)
     db.commit()
-    db.refresh(db_order)
 
-    # Publish to RabbitMQ for async processing
+    # Publish to RabbitMQ after the response is sent
     order_message = OrderMessage(
         order_id=db_order.id,
-        order_type="market",
+        order_type=order_type,
         user_id=db_order.user_id,
         ticker=instrument.ticker,
-        direction=db_order.direction,
-        qty=db_order.qty,
-        timestamp=db_order.timestamp
+        timestamp=db_order.timestamp,
+        **fields
     )
+    background_tasks.add_task(order_publisher.publish_order, order_message)
 
-    order_publisher.publish_order(order_message)
-
-    return MarketOrder(
-        id=UUID(db_order.id),
+    return response_model(
+        id=db_order.id,
         status=db_order.status,
-        user_id=UUID(db_order.user_id),
-        direction=db_order.direction,
+        user_id=db_order.user_id,
         ticker=instrument.ticker,
-        qty=db_order.qty,
-        timestamp=db_order.timestamp
+        timestamp=db_order.timestamp,
+        **fields
     )
 
 
-@app.post("/orders/limit", response_model=LimitOrder)
-async def create_limit_order(
-        order: LimitOrderCreate,
+@app.post("/orders/market", response_model=MarketOrder)
+def create_market_order(
+        order: MarketOrderCreate,
         api_key: str,
-        user: UserDB = Depends(authenticate_user),
+        background_tasks: BackgroundTasks,
+        user: CachedUser = Depends(authenticate_user),
         db: Session = Depends(get_db)
 ):
-    # Verify instrument exists
-    instrument = get_instrument_by_ticker(db, order.ticker)
-    if not instrument:
-        raise HTTPException(status_code=404, detail="Instrument not found")
+    return _create_order("market", order, user, db, background_tasks)
 
-    # Create order in database
-    db_order = LimitOrderDB(
-        user_id=user.id,
-        instrument_id=instrument.id,
-        direction=order.direction,
-        qty=order.qty,
-        price=order.price
-    )
-    db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
 
-    # Publish to RabbitMQ for async processing
-    order_message = OrderMessage(
-        order_id=db_order.id,
-        order_type="limit",
-        user_id=db_order.user_id,
-        ticker=instrument.ticker,
-        direction=db_order.direction,
-        qty=db_order.qty,
-        price=db_order.price,
-        timestamp=db_order.timestamp
-    )
+@app.post("/orders/market/bulk", response_model=List[MarketOrder])
+def create_market_orders_bulk(
+        orders: Annotated[List[MarketOrderCreate], Body(max_length=1000)],
+        api_key: str,
+        background_tasks: BackgroundTasks,
+        user: CachedUser = Depends(authenticate_user),
+        db: Session = Depends(get_db)
+):
+    # Verify all instruments exist before writing anything
+    instruments = {}
+    for order in orders:
+        if order.ticker not in instruments:
+            instrument = get_instrument_by_ticker(db, order.ticker)
+            if not instrument:
+                raise HTTPException(status_code=404, detail=f"Instrument {order.ticker} not found")
+            instruments[order.ticker] = instrument
+
+    # Single executemany INSERT and one commit for the whole batch
+    timestamp = datetime.utcnow()
+    rows = [
+        dict(
+            id=uuid4(),
+            status=OrderStatus.NEW,
+            user_id=user.id,
+            instrument_id=instruments[order.ticker].id,
+            direction=order.direction,
+            qty=order.qty,
+            timestamp=timestamp
+        )
+        for order in orders
+    ]
+    if rows:
+        db.execute(insert(MarketOrderDB), rows)
+        db.commit()
+
+    background_tasks.add_task(order_publisher.publish_orders, [
+        OrderMessage(
+            order_id=row["id"],
+            order_type="market",
+            user_id=row["user_id"],
+            ticker=order.ticker,
+            direction=row["direction"],
+            qty=row["qty"],
+            timestamp=row["timestamp"]
+        )
+        for row, order in zip(rows, orders)
+    ])
 
-    order_publisher.publish_order(order_message)
+    return [
+        MarketOrder(
+            id=row["id"],
+            status=row["status"],
+            user_id=row["user_id"],
+            direction=row["direction"],
+            ticker=order.ticker,
+            qty=row["qty"],
+            timestamp=row["timestamp"]
+        )
+        for row, order in zip(rows, orders)
+    ]
 
-    return LimitOrder(
-        id=UUID(db_order.id),
-        status=db_order.status,
-        user_id=UUID(db_order.user_id),
-        direction=db_order.direction,
-        ticker=instrument.ticker,
-        qty=db_order.qty,
-        price=db_order.price,
-        timestamp=db_order.timestamp
-    )
+
+@app.post("/orders/limit", response_model=LimitOrder)
+def create_limit_order(
+        order: LimitOrderCreate,
+        api_key: str,
+        background_tasks: BackgroundTasks,
+        user: CachedUser = Depends(authenticate_user),
+        db: Session = Depends(get_db)
+):
+    return _create_order("limit", order, user, db, background_tasks)
 
 
 @app.get("/orders/market/{order_id}", response_model=MarketOrder)
-def get_market_order(order_id: str, db: Session = Depends(get_db)):
-    db_order = db.query(MarketOrderDB).filter(MarketOrderDB.id == order_id).first()
+def get_market_order(order_id: UUID, db: Session = Depends(get_db)):
+    db_order = db.get(MarketOrderDB, order_id, options=[joinedload(MarketOrderDB.instrument)])
     if not db_order:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    return MarketOrder(
-        id=UUID(db_order.id),
-        status=db_order.status,
-        user_id=UUID(db_order.user_id),
-        direction=db_order.direction,
-        ticker=db_order.instrument.ticker,
-        qty=db_order.qty,
-        timestamp=db_order.timestamp
-    )
+    return MarketOrder.model_validate(db_order)
 
 
 @app.get("/orders/limit/{order_id}", response_model=LimitOrder)
-def get_limit_order(order_id: str, db: Session = Depends(get_db)):
-    db_order = db.query(LimitOrderDB).filter(LimitOrderDB.id == order_id).first()
+def get_limit_order(order_id: UUID, db: Session = Depends(get_db)):
+    db_order = db.get(LimitOrderDB, order_id, options=[joinedload(LimitOrderDB.instrument)])
     if not db_order:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    return LimitOrder(
-        id=UUID(db_order.id),
-        status=db_order.status,
-        user_id=UUID(db_order.user_id),
-        direction=db_order.direction,
-        ticker=db_order.instrument.ticker,
-        qty=db_order.qty,
-        price=db_order.price,
-        timestamp=db_order.timestamp
-    )
+    return LimitOrder.model_validate(db_order)
 
 
 # Get user's orders
 @app.get("/users/{user_id}/orders/market", response_model=List[MarketOrder])
-def get_user_market_orders(user_id: str, db: Session = Depends(get_db)):
-    db_orders = db.query(MarketOrderDB).filter(MarketOrderDB.user_id == user_id).all()
-    return [
-        MarketOrder(
-            id=UUID(order.id),
-            status=order.status,
-            user_id=UUID(order.user_id),
-            direction=order.direction,
-            ticker=order.instrument.ticker,
-            qty=order.qty,
-            timestamp=order.timestamp
-        )
-        for order in db_orders
-    ]
+def get_user_market_orders(
+        user_id: UUID,
+        limit: int = Query(100, ge=1, le=1000),
+        offset: int = Query(0, ge=0),
+        db: Session = Depends(get_db)
+):
+    # Newest first, one page at a time; id breaks timestamp ties (bulk orders share one)
+    db_orders = db.query(MarketOrderDB).options(joinedload(MarketOrderDB.instrument)).filter(
+        MarketOrderDB.user_id == user_id
+    ).order_by(MarketOrderDB.timestamp.desc(), MarketOrderDB.id).limit(limit).offset(offset).all()
+    return [MarketOrder.model_validate(order) for order in db_orders]
 
 
 @app.get("/users/{user_id}/orders/limit", response_model=List[LimitOrder])
-def get_user_limit_orders(user_id: str, db: Session = Depends(get_db)):
-    db_orders = db.query(LimitOrderDB).filter(LimitOrderDB.user_id == user_id).all()
-    return [
-        LimitOrder(
-            id=UUID(order.id),
-            status=order.status,
-            user_id=UUID(order.user_id),
-            direction=order.direction,
-            ticker=order.instrument.ticker,
-            qty=order.qty,
-            price=order.price,
-            timestamp=order.timestamp
-        )
-        for order in db_orders
-    ]
+def get_user_limit_orders(
+        user_id: UUID,
+        limit: int = Query(100, ge=1, le=1000),
+        offset: int = Query(0, ge=0),
+        db: Session = Depends(get_db)
+):
+    # Newest first, one page at a time; id breaks timestamp ties (bulk orders share one)
+    db_orders = db.query(LimitOrderDB).options(joinedload(LimitOrderDB.instrument)).filter(
+        LimitOrderDB.user_id == user_id
+    ).order_by(LimitOrderDB.timestamp.desc(), LimitOrderDB.id).limit(limit).offset(offset).all()
+    return [LimitOrder.model_validate(order) for order in db_orders]
 
 
 if __name__ == "__main__":
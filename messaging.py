@@ -1,16 +1,33 @@
+import os
+import asyncio
 import pika
-import json
+import aio_pika
+from aio_pika.pool import Pool
+import orjson
 import logging
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 from sqlalchemy.orm import Session
 import time
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from schemas import OrderMessage, OrderStatus
 from database import SessionLocal, MarketOrderDB, LimitOrderDB
 
 logger = logging.getLogger(__name__)
 
+# Unacked deliveries per consumer; bounded to keep memory in check
+RABBITMQ_PREFETCH = int(os.getenv("RABBITMQ_PREFETCH", "100"))
+# Threads processing deliveries off the pika IO thread
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "8"))
+# Settled deliveries are acked together with multiple=True once either limit is hit
+ACK_BATCH_SIZE = int(os.getenv("ACK_BATCH_SIZE", "50"))
+ACK_FLUSH_INTERVAL = 0.2  # seconds
+# Publisher channels per API process, so concurrent publishes don't queue behind one channel
+RABBITMQ_CHANNEL_POOL_SIZE = int(os.getenv("RABBITMQ_CHANNEL_POOL_SIZE", "10"))
+
 
 class RabbitMQConnection:
     def __init__(self, host: str = 'localhost', port: int = 5672,
@@ -107,71 +124,170 @@ class RabbitMQConnection:
                 logger.error(f"Failed to declare exchange '{exchange_name}': {e}")
 
 
-# Global RabbitMQ connection instance
+class AsyncRabbitMQConnection:
+    """Publisher-side connection sharing the FastAPI event loop; reconnects on its own once established"""
+
+    def __init__(self, host: str = 'localhost', port: int = 5672,
+                 username: Optional[str] = None, password: Optional[str] = None,
+                 max_retries: int = 3, retry_delay: int = 5):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.connection = None
+        self.channel = None
+
+    async def connect(self):
+        for attempt in range(self.max_retries):
+            try:
+                logger.info(
+                    f"Attempting to connect to RabbitMQ at {self.host}:{self.port} (attempt {attempt + 1}/{self.max_retries})")
+
+                if self.username and self.password:
+                    self.connection = await aio_pika.connect_robust(
+                        host=self.host, port=self.port, login=self.username, password=self.password
+                    )
+                else:
+                    self.connection = await aio_pika.connect_robust(host=self.host, port=self.port)
+
+                # Publisher confirms are on by default: publish() resolves once the broker acks
+                self.channel = await self.connection.channel()
+                self.connection.reconnect_callbacks.add(self._on_reconnect)
+                logger.info(f"Successfully connected to RabbitMQ at {self.host}:{self.port}")
+                return True
+
+            except Exception as e:
+                logger.error(
+                    f"Error connecting to RabbitMQ (attempt {attempt + 1}): {type(e).__name__}: {str(e)}")
+
+            if attempt < self.max_retries - 1:
+                logger.info(f"Retrying in {self.retry_delay} seconds...")
+                await asyncio.sleep(self.retry_delay)
+
+        logger.error(f"Failed to connect to RabbitMQ after {self.max_retries} attempts")
+        return False
+
+    def _on_reconnect(self, connection):
+        logger.info(f"Reconnected to RabbitMQ at {self.host}:{self.port}")
+
+    async def disconnect(self):
+        try:
+            if self.connection and not self.connection.is_closed:
+                await self.connection.close()
+                logger.info("Disconnected from RabbitMQ")
+        except Exception as e:
+            logger.error(f"Error during disconnect: {e}")
+
+
+# Global RabbitMQ connection instances: blocking for the consumer process, async for the API
 rabbitmq = RabbitMQConnection()
+async_rabbitmq = AsyncRabbitMQConnection()
+
+
+class PublisherChannel:
+    """Pooled publisher channel with its exchange handle resolved once, when the channel is opened"""
+
+    def __init__(self, channel, exchange):
+        self.channel = channel
+        self.exchange = exchange
+
+    async def close(self):
+        await self.channel.close()
 
 
 class OrderPublisher:
     def __init__(self):
         self.exchange_name = 'orders_exchange'
+        self.channel_pool = None  # created once the exchange is declared
 
-    def setup_exchange(self):
+    async def setup_exchange(self):
         """Setup exchange and queues with proper error handling"""
-        if not rabbitmq.connect():
+        if async_rabbitmq.channel is None:
             logger.error("Cannot setup exchange - RabbitMQ connection failed")
             return False
 
         try:
-            rabbitmq.declare_exchange(self.exchange_name, 'direct')
-            rabbitmq.declare_queue('market_orders', durable=True)
-            rabbitmq.declare_queue('limit_orders', durable=True)
+            channel = async_rabbitmq.channel
+            exchange = await channel.declare_exchange(self.exchange_name, aio_pika.ExchangeType.DIRECT)
+            market_queue = await channel.declare_queue('market_orders', durable=True)
+            limit_queue = await channel.declare_queue('limit_orders', durable=True)
 
             # Bind queues to exchange
-            rabbitmq.channel.queue_bind(
-                exchange=self.exchange_name,
-                queue='market_orders',
-                routing_key='market'
-            )
-            rabbitmq.channel.queue_bind(
-                exchange=self.exchange_name,
-                queue='limit_orders',
-                routing_key='limit'
-            )
+            await market_queue.bind(exchange, routing_key='market')
+            await limit_queue.bind(exchange, routing_key='limit')
+            self.channel_pool = Pool(self._open_channel, max_size=RABBITMQ_CHANNEL_POOL_SIZE)
             logger.info("Exchange and queues setup completed successfully")
             return True
         except Exception as e:
             logger.error(f"Failed to setup exchange and queues: {e}")
             return False
 
-    def publish_order(self, order_message: OrderMessage):
+    async def _open_channel(self):
+        # Returned (unroutable) mandatory publishes raise instead of resolving as delivered
+        channel = await async_rabbitmq.connection.channel(on_return_raises=True)
+        # Exchange is declared at startup; ensure=False builds the handle locally without a round trip
+        exchange = await channel.get_exchange(self.exchange_name, ensure=False)
+        return PublisherChannel(channel, exchange)
+
+    async def close(self):
+        if self.channel_pool and not self.channel_pool.is_closed:
+            await self.channel_pool.close()
+
+    def _publish(self, publisher_channel: PublisherChannel, order_message: OrderMessage, timestamp: datetime):
+        # Routing keys match order types ('market' / 'limit')
+        return publisher_channel.exchange.publish(
+            aio_pika.Message(
+                body=orjson.dumps(order_message.model_dump()),  # UUID/datetime handled natively
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                timestamp=timestamp
+            ),
+            routing_key=order_message.order_type,
+            mandatory=True  # Unroutable messages come back and raise on the pooled channels
+        )
+
+    async def publish_order(self, order_message: OrderMessage):
+        if self.channel_pool is None:
+            logger.error("Cannot publish - order publisher not initialised, RabbitMQ setup failed at startup")
+            return False
         try:
-            if not rabbitmq.is_connected():
-                logger.info("Reconnecting to RabbitMQ...")
-                if not rabbitmq.connect():
-                    logger.error("Failed to reconnect to RabbitMQ")
-                    return False
-
-            routing_key = 'market' if order_message.order_type == 'market' else 'limit'
-
-            rabbitmq.channel.basic_publish(
-                exchange=self.exchange_name,
-                routing_key=routing_key,
-                body=order_message.json(),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Make message persistent
-                    timestamp=int(datetime.now().timestamp())
-                )
-            )
+            async with self.channel_pool.acquire() as channel:
+                await self._publish(channel, order_message, datetime.now())
             logger.info(f"Published {order_message.order_type} order: {order_message.order_id}")
             return True
         except Exception as e:
             logger.error(f"Failed to publish order: {type(e).__name__}: {str(e)}")
             return False
 
+    async def publish_orders(self, order_messages: List[OrderMessage]):
+        """Publish a batch of orders concurrently and wait for all broker confirms together"""
+        if not order_messages:
+            return True
+        if self.channel_pool is None:
+            logger.error("Cannot publish - order publisher not initialised, RabbitMQ setup failed at startup")
+            return False
+        try:
+            timestamp = datetime.now()
+            async with self.channel_pool.acquire() as channel:
+                await asyncio.gather(*(
+                    self._publish(channel, order_message, timestamp) for order_message in order_messages
+                ))
+            for order_message in order_messages:
+                logger.info(f"Published {order_message.order_type} order: {order_message.order_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to publish order: {type(e).__name__}: {str(e)}")
+            return False
+
 
 class OrderConsumer:
-    def __init__(self):
-        pass
+    def __init__(self, max_workers: int = CONSUMER_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Both touched only on the pika IO thread
+        self._in_flight = deque()  # delivery tags in delivery order
+        self._settled = {}  # delivery tag -> True (ack) / False (nack)
+        self._stopping = False
 
     def setup_consumer(self):
         if not rabbitmq.connect():
@@ -188,16 +304,20 @@ class OrderConsumer:
             return False
 
     def process_market_order(self, ch, method, properties, body):
+        # Runs on the pika IO thread: hand off so the next delivery is received meanwhile
+        if self._stopping:
+            return  # left unacked, the broker redelivers it
+        self._in_flight.append(method.delivery_tag)
+        self.executor.submit(self._process_market_order, method.delivery_tag, body)
+
+    def _process_market_order(self, delivery_tag, body):
         try:
-            order_data = json.loads(body)
-            order_message = OrderMessage(**order_data)
+            order_message = OrderMessage.model_validate_json(body)
 
             # Process the market order
             db = SessionLocal()
             try:
-                db_order = db.query(MarketOrderDB).filter(
-                    MarketOrderDB.id == order_message.order_id
-                ).first()
+                db_order = db.get(MarketOrderDB, order_message.order_id)
 
                 if db_order:
                     # Simulate order processing - implement your matching logic here
@@ -205,37 +325,80 @@ class OrderConsumer:
                     db.commit()
                     logger.info(f"Processed market order: {order_message.order_id}")
 
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                self._ack(delivery_tag)
             finally:
                 db.close()
 
         except Exception as e:
             logger.error(f"Error processing market order: {type(e).__name__}: {str(e)}")
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            self._nack(delivery_tag)
 
     def process_limit_order(self, ch, method, properties, body):
+        # Runs on the pika IO thread: hand off so the next delivery is received meanwhile
+        if self._stopping:
+            return  # left unacked, the broker redelivers it
+        self._in_flight.append(method.delivery_tag)
+        self.executor.submit(self._process_limit_order, method.delivery_tag, body)
+
+    def _process_limit_order(self, delivery_tag, body):
         try:
-            order_data = json.loads(body)
-            order_message = OrderMessage(**order_data)
+            order_message = OrderMessage.model_validate_json(body)
 
             # Process the limit order
             db = SessionLocal()
             try:
-                db_order = db.query(LimitOrderDB).filter(
-                    LimitOrderDB.id == order_message.order_id
-                ).first()
+                db_order = db.get(LimitOrderDB, order_message.order_id)
 
                 if db_order:
                     # Implement your limit order matching logic here
                     logger.info(f"Processing limit order: {order_message.order_id}")
 
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                self._ack(delivery_tag)
             finally:
                 db.close()
 
         except Exception as e:
             logger.error(f"Error processing limit order: {type(e).__name__}: {str(e)}")
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            self._nack(delivery_tag)
+
+    def _ack(self, delivery_tag):
+        # Channel methods must be called from the connection's own thread
+        rabbitmq.connection.add_callback_threadsafe(
+            functools.partial(self._settle, delivery_tag, True)
+        )
+
+    def _nack(self, delivery_tag):
+        rabbitmq.connection.add_callback_threadsafe(
+            functools.partial(self._settle, delivery_tag, False)
+        )
+
+    def _settle(self, delivery_tag, ack):
+        self._settled[delivery_tag] = ack
+        if len(self._settled) >= ACK_BATCH_SIZE:
+            self._flush_acks()
+
+    def _flush_acks(self):
+        """Ack/nack the settled prefix of in-flight deliveries, one frame per run of equal outcomes"""
+        last_tag, last_ack = None, None
+        # Workers finish out of order; multiple=True is only safe up to the first unsettled tag
+        while self._in_flight and self._in_flight[0] in self._settled:
+            tag = self._in_flight.popleft()
+            ack = self._settled.pop(tag)
+            if last_ack is not None and ack != last_ack:
+                self._send_settlement(last_tag, last_ack)
+            last_tag, last_ack = tag, ack
+        if last_tag is not None:
+            self._send_settlement(last_tag, last_ack)
+
+    def _send_settlement(self, delivery_tag, ack):
+        if ack:
+            rabbitmq.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+        else:
+            rabbitmq.channel.basic_nack(delivery_tag=delivery_tag, multiple=True, requeue=False)
+
+    def _flush_acks_periodically(self):
+        self._flush_acks()
+        rabbitmq.connection.call_later(ACK_FLUSH_INTERVAL, self._flush_acks_periodically)
 
     def start_consuming(self):
         if not rabbitmq.is_connected():
@@ -244,7 +407,7 @@ class OrderConsumer:
                 return
 
         try:
-            rabbitmq.channel.basic_qos(prefetch_count=10)  # Process 10 messages at a time
+            rabbitmq.channel.basic_qos(prefetch_count=RABBITMQ_PREFETCH, global_qos=False)
 
             rabbitmq.channel.basic_consume(
                 queue='market_orders',
@@ -256,10 +419,29 @@ class OrderConsumer:
                 on_message_callback=self.process_limit_order
             )
 
+            rabbitmq.connection.call_later(ACK_FLUSH_INTERVAL, self._flush_acks_periodically)
+
             logger.info("Starting to consume messages...")
             rabbitmq.channel.start_consuming()
         except Exception as e:
             logger.error(f"Error during message consumption: {type(e).__name__}: {str(e)}")
+        finally:
+            self._stopping = True
+            self.executor.shutdown(wait=True)
+            self._flush_pending_acks()
+
+    def _flush_pending_acks(self):
+        """Send outcomes still waiting for a batch flush, so they aren't redelivered on restart"""
+        if not rabbitmq.is_connected():
+            return
+        try:
+            # Cancel consumers first; pika requeues deliveries buffered but not yet dispatched
+            rabbitmq.channel.stop_consuming()
+            # Run the _settle callbacks workers queued after the IO loop stopped
+            rabbitmq.connection.process_data_events(time_limit=0)
+            self._flush_acks()
+        except Exception as e:
+            logger.error(f"Failed to flush pending acks: {type(e).__name__}: {str(e)}")
 
 
 # Global instances
@@ -1,9 +1,8 @@
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, ConfigDict, field_validator
 from enum import Enum
 from datetime import datetime
 from uuid import UUID
 from typing import Optional
-from re import fullmatch
 
 
 # Enums
@@ -37,8 +36,7 @@ class User(BaseModel):
     role: UserRole
     api_key: str
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # Instrument schemas
@@ -48,7 +46,8 @@ class InstrumentCreate(BaseModel):
 
     @field_validator('ticker')
     def check_ticker(cls, value):
-        if not fullmatch(r'^[A-Z]{2,10}$', value):
+        # Same as ^[A-Z]{2,10}$ without going through the regex engine
+        if not (2 <= len(value) <= 10 and value.isascii() and value.isalpha() and value.isupper()):
             raise ValueError(f'Invalid ticker "{value}"')
         return value
 
@@ -58,8 +57,7 @@ class Instrument(BaseModel):
     name: str
     ticker: str
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # Order schemas
@@ -84,8 +82,7 @@ class MarketOrder(BaseModel):
     qty: int
     timestamp: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class LimitOrderCreate(BaseModel):
@@ -117,15 +114,14 @@ class LimitOrder(BaseModel):
     price: int
     timestamp: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # Message schemas for RabbitMQ
 class OrderMessage(BaseModel):
-    order_id: str
+    order_id: UUID
     order_type: str  # "market" or "limit"
-    user_id: str
+    user_id: UUID
     ticker: str
     direction: Direction
     qty: int